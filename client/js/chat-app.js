@@ -7,6 +7,13 @@ class TraeAIChat {
     constructor() {
         this.ws = null;
         this.currentConversationId = 'default';
+        // Identifies this page to the server so replies and replays reach only us.
+        // Kept in memory: a reload starts an empty chat, so there is nothing to replay.
+        this.sessionId = (window.crypto && crypto.randomUUID)
+            ? crypto.randomUUID()
+            : `session_${Date.now()}_${Math.random().toString(36).slice(2)}`;
+        this.lastSeq = null;  // Last sequenced frame received, used to resume after reconnect
+        this.streamEpoch = null;  // Server stream the sequence numbers belong to
         this.isRecording = false;
         this.mediaRecorder = null;
         this.audioChunks = [];
@@ -96,10 +103,34 @@ class TraeAIChat {
         this.ws.onopen = () => {
             console.log('WebSocket connected');
             this.updateStatus('Connected', true);
+            
+            // Ask the server for anything sent while we were disconnected
+            this.ws.send(JSON.stringify({
+                type: 'resume',
+                data: {
+                    conversation_id: this.currentConversationId,
+                    session_id: this.sessionId,
+                    last_seq: this.lastSeq,
+                    epoch: this.streamEpoch
+                }
+            }));
         };
         
         this.ws.onmessage = (event) => {
             const data = JSON.parse(event.data);
+            
+            if (typeof data.seq === 'number') {
+                if (data.epoch !== this.streamEpoch) {
+                    // Server restarted or recreated the stream, so numbering starts over
+                    this.streamEpoch = data.epoch;
+                    this.lastSeq = null;
+                }
+                
+                // Skip frames we already handled before a reconnect
+                if (this.lastSeq !== null && data.seq <= this.lastSeq) return;
+                this.lastSeq = data.seq;
+            }
+            
             this.handleWebSocketMessage(data);
         };
         
@@ -119,8 +150,29 @@ class TraeAIChat {
     handleWebSocketMessage(data) {
         switch (data.type) {
             case 'chat_response':
+                this.showTypingIndicator(false);
                 this.addMessage(data.data.response, 'assistant');
                 break;
+            case 'resumed': {
+                // A restarted server counts from 1 again; our old numbers no longer apply
+                const streamReset = this.streamEpoch !== null && (
+                    data.epoch !== this.streamEpoch ||
+                    (this.lastSeq !== null && data.data.last_seq < this.lastSeq)
+                );
+                this.streamEpoch = data.epoch;
+                if (this.lastSeq === null || streamReset) {
+                    this.lastSeq = data.data.last_seq;
+                }
+                if (data.data.gap || streamReset) {
+                    this.addMessage('Some messages sent while you were disconnected could not be recovered.', 'assistant');
+                }
+                this.showTypingIndicator(data.data.generating);
+                break;
+            }
+            case 'error':
+                this.showTypingIndicator(false);
+                this.addMessage('Sorry, I encountered an error. Please try again.', 'assistant');
+                break;
             case 'new_message':
                 this.addMessage(data.data.content, data.data.role);
                 break;
@@ -156,7 +208,8 @@ class TraeAIChat {
                     type: 'chat',
                     data: {
                         message: message,
-                        conversation_id: this.currentConversationId
+                        conversation_id: this.currentConversationId,
+                        session_id: this.sessionId
                     }
                 }));
             } else {
@@ -345,7 +398,9 @@ class TraeAIChat {
                     this.ws.send(JSON.stringify({
                         type: 'screen_share',
                         data: {
-                            screen: imageData
+                            screen: imageData,
+                            conversation_id: this.currentConversationId,
+                            session_id: this.sessionId
                         }
                     }));
                 }
@@ -5,29 +5,36 @@ Multimodal chat assistant for coding with voice, screen sharing, and keyboard in
 """
 
 import os
+import re
+import time
 import asyncio
+import contextlib
 import json
 import base64
 import logging
+from collections import deque
 from datetime import datetime
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Union
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, UploadFile, File
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 
 import torch
 import requests
 from huggingface_hub import hf_hub_download, snapshot_download
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from transformers import AutoTokenizer, AutoModelForCausalLM, StoppingCriteria, StoppingCriteriaList
 from PIL import Image
 import io
 import numpy as np
 import cv2
 import subprocess
 import tempfile
+import uuid
+
+from image_preprocessing import ImagePreprocessor, FrameBatcher
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -62,6 +69,16 @@ class ChatRequest(BaseModel):
     context: Optional[Dict[str, Any]] = None
     multimodal_data: Optional[Dict[str, Any]] = None
 
+class BatchJobStatus(BaseModel):
+    job_id: str
+    status: str  # queued, running, completed, failed
+    total: int
+    completed: int
+    failed: int
+    created_at: str
+    updated_at: str
+    error: Optional[str] = None
+
 class SystemStatus(BaseModel):
     status: str
     model_loaded: bool
@@ -71,8 +88,199 @@ class SystemStatus(BaseModel):
 # Global variables
 conversations: Dict[str, List[ChatMessage]] = {}
 connected_clients: Dict[str, WebSocket] = {}
+session_streams: Dict[str, "SessionStream"] = {}
 model_cache = {}
 
+# Frames kept per client session for replay after a WebSocket reconnect
+REPLAY_BUFFER_SIZE = int(os.environ.get("REPLAY_BUFFER_SIZE", "50"))
+STREAM_IDLE_TTL = float(os.environ.get("STREAM_IDLE_TTL", "1800"))  # seconds without sockets or tasks
+MAX_SESSION_STREAMS = int(os.environ.get("MAX_SESSION_STREAMS", "1000"))
+
+# Batch job configuration
+BATCH_JOBS_DIR = os.environ.get("BATCH_JOBS_DIR", os.path.join(tempfile.gettempdir(), "trae_batch_jobs"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "8"))  # prompts per generate() call
+BATCH_MAX_TOKENS = int(os.environ.get("BATCH_MAX_TOKENS", "8192"))  # padded prompt tokens per batch
+
+# Decoding policies per request type; ChatRequest.context may override
+# request_type, max_new_tokens, temperature, stop_sequences and stop_on_code_fence
+GENERATION_POLICIES = {
+    "short": {"max_new_tokens": 128, "stop_on_code_fence": True},  # yes/no and quick factual questions
+    "chat": {"max_new_tokens": 512, "stop_on_code_fence": False},
+    "code": {"max_new_tokens": 1024, "stop_on_code_fence": False},  # whole functions or files
+}
+MAX_NEW_TOKENS_LIMIT = 2048
+TURN_STOP_SEQUENCES = ["<end_of_turn>", "<start_of_turn>", "\nUser:"]
+
+CODE_REQUEST_PATTERN = re.compile(
+    r"```|\b(write|implement|refactor|generate|create|build|convert|rewrite|fix)\b.*"
+    r"\b(code|function|class|script|module|program|file|component|tests?|endpoint|api|query)\b",
+    re.IGNORECASE | re.DOTALL
+)
+# Only plain yes/no questions are "short"; anything asking for an explanation
+# or example stays on the chat budget until /stats/generation says otherwise
+SHORT_REQUEST_PATTERN = re.compile(
+    r"^\s*(is|are|does|do|can|should|was|were|has|have|did)\b[^\n]*\?\s*$",
+    re.IGNORECASE
+)
+SHORT_REQUEST_EXCLUDE_PATTERN = re.compile(
+    r"^\s*(can|could|would|will)\s+you\b"
+    r"|\b(how|why|what|which|explain|show|examples?|help|describe|understand|compare|difference|walk)\b",
+    re.IGNORECASE
+)
+
+def infer_request_type(message: str) -> str:
+    """Guess the request type from the user message"""
+    if CODE_REQUEST_PATTERN.search(message):
+        return "code"
+    if (len(message) <= 120 and SHORT_REQUEST_PATTERN.match(message)
+            and not SHORT_REQUEST_EXCLUDE_PATTERN.search(message)):
+        return "short"
+    return "chat"
+
+def resolve_generation_policy(message: str, options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build the decoding policy for a request from its type and per-request overrides
+    
+    Raises ValueError for malformed overrides. A temperature of 0 selects
+    greedy decoding.
+    """
+    options = options or {}
+    request_type = options.get("request_type")
+    if request_type is None:
+        request_type = infer_request_type(message)
+    elif request_type not in GENERATION_POLICIES:
+        raise ValueError(f"request_type must be one of: {', '.join(GENERATION_POLICIES)}")
+    
+    policy = {"request_type": request_type, "temperature": 0.7, **GENERATION_POLICIES[request_type]}
+    
+    if "max_new_tokens" in options:
+        max_new_tokens = options["max_new_tokens"]
+        if isinstance(max_new_tokens, bool) or not isinstance(max_new_tokens, int):
+            raise ValueError("max_new_tokens must be an integer")
+        policy["max_new_tokens"] = max(1, min(max_new_tokens, MAX_NEW_TOKENS_LIMIT))
+    
+    if "temperature" in options:
+        temperature = options["temperature"]
+        if isinstance(temperature, bool) or not isinstance(temperature, (int, float)) or temperature < 0:
+            raise ValueError("temperature must be a number >= 0")
+        policy["temperature"] = float(temperature)
+    
+    if "stop_on_code_fence" in options:
+        if not isinstance(options["stop_on_code_fence"], bool):
+            raise ValueError("stop_on_code_fence must be a boolean")
+        policy["stop_on_code_fence"] = options["stop_on_code_fence"]
+    
+    stop_sequences = options.get("stop_sequences", [])
+    # A bare string would be split into single-character stop sequences
+    if not isinstance(stop_sequences, list) or not all(isinstance(stop, str) and stop for stop in stop_sequences):
+        raise ValueError("stop_sequences must be a list of non-empty strings")
+    policy["stop_sequences"] = TURN_STOP_SEQUENCES + stop_sequences
+    return policy
+
+def sampling_options(policy: Dict[str, Any]) -> Dict[str, Any]:
+    """generate() sampling arguments for a policy; temperature 0 means greedy decoding"""
+    if policy["temperature"] > 0:
+        return {"do_sample": True, "temperature": policy["temperature"], "top_p": 0.9}
+    return {"do_sample": False}
+
+def truncate_at_stop(text: str, stop_sequences: List[str], stop_on_code_fence: bool = False) -> str:
+    """Cut generated text at the first stop sequence or just after the first closed code fence"""
+    cut = len(text)
+    for stop in stop_sequences:
+        index = text.find(stop)
+        if index != -1:
+            cut = min(cut, index)
+    if stop_on_code_fence:
+        opening = text.find("```")
+        closing = text.find("```", opening + 3) if opening != -1 else -1
+        if closing != -1:
+            cut = min(cut, closing + 3)
+    return text[:cut]
+
+class StopSequenceCriteria(StoppingCriteria):
+    """Stops generation at a stop sequence or once a code fence is closed
+    
+    Only a short tail of the generated tokens is decoded on each step; the
+    full completion is decoded only while a fence marker is in that tail.
+    For a batch, each row's stop reason is tracked and generation ends once
+    every row has stopped or reached EOS.
+    """
+    
+    def __init__(self, tokenizer, prompt_length: int, stop_sequences: List[str], stop_on_code_fence: bool = False,
+                 batch_size: int = 1):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.stop_sequences = stop_sequences
+        self.stop_on_code_fence = stop_on_code_fence
+        self.window = max([16] + [len(stop) for stop in stop_sequences])
+        self.stop_reasons: List[Optional[str]] = [None] * batch_size
+    
+    @property
+    def stop_reason(self) -> Optional[str]:
+        return self.stop_reasons[0]
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
+        for row in range(input_ids.shape[0]):
+            if self.stop_reasons[row] is None:
+                self.stop_reasons[row] = self._check(input_ids[row, self.prompt_length:])
+        return all(self.stop_reasons)
+    
+    def _check(self, generated: torch.LongTensor) -> Optional[str]:
+        eos_token_id = self.tokenizer.eos_token_id
+        if eos_token_id is not None and (generated == eos_token_id).any():
+            return "eos"
+        
+        tail = self.tokenizer.decode(generated[-self.window:], skip_special_tokens=False)
+        if any(stop in tail for stop in self.stop_sequences):
+            return "stop_sequence"
+        
+        if self.stop_on_code_fence and "```" in tail:
+            fences = self.tokenizer.decode(generated, skip_special_tokens=False).count("```")
+            if fences >= 2 and fences % 2 == 0:
+                return "code_fence"
+        
+        return None
+
+class GenerationStats:
+    """Decode budget vs. actual length per request type, for tuning GENERATION_POLICIES"""
+    
+    def __init__(self):
+        self.by_type: Dict[str, Dict[str, float]] = {}
+    
+    def record(self, request_type: str, budget: int, generated: int, stop_reason: str, elapsed: float):
+        stats = self.by_type.setdefault(request_type, {
+            "requests": 0,
+            "budget_tokens": 0,
+            "generated_tokens": 0,
+            "budget_exhausted": 0,
+            "stopped_early": 0,
+            "generation_seconds": 0.0
+        })
+        stats["requests"] += 1
+        stats["budget_tokens"] += budget
+        stats["generated_tokens"] += generated
+        stats["generation_seconds"] += elapsed
+        if stop_reason == "max_new_tokens":
+            stats["budget_exhausted"] += 1
+        elif stop_reason in ("stop_sequence", "code_fence"):
+            stats["stopped_early"] += 1
+        
+        logger.info(
+            f"Generation stats: type={request_type} budget={budget} generated={generated} "
+            f"stop={stop_reason} time={elapsed:.2f}s"
+        )
+    
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        for request_type, stats in self.by_type.items():
+            summary[request_type] = {
+                **stats,
+                "avg_generated_tokens": stats["generated_tokens"] / stats["requests"],
+                "budget_utilization": stats["generated_tokens"] / max(1, stats["budget_tokens"])
+            }
+        return summary
+
+generation_stats = GenerationStats()
+
 class TraeAIAssistant:
     def __init__(self):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -82,6 +290,10 @@ class TraeAIAssistant:
         self.tokenizer = None
         self.model = None
         
+        # Image decoding runs in a process pool so it never blocks the event loop
+        self.image_preprocessor = ImagePreprocessor()
+        self.frame_batcher = FrameBatcher(self.image_preprocessor)
+        
         logger.info(f"Initializing Trae AI Assistant on {self.device}")
         
     async def load_models(self):
@@ -99,6 +311,8 @@ class TraeAIAssistant:
             
             if self.tokenizer.pad_token is None:
                 self.tokenizer.pad_token = self.tokenizer.eos_token
+            # Decoder-only models need left padding for batched generation
+            self.tokenizer.padding_side = "left"
             
             logger.info("Model loaded successfully!")
             return True
@@ -107,9 +321,12 @@ class TraeAIAssistant:
             logger.error(f"Error loading model: {e}")
             return False
     
-    async def generate_response(self, prompt: str, conversation_history: List[ChatMessage] = None, multimodal_data: Dict = None) -> str:
+    async def generate_response(self, prompt: str, conversation_history: List[ChatMessage] = None, multimodal_data: Dict = None,
+                                generation_policy: Dict = None) -> str:
         """Generate AI response with context awareness"""
         try:
+            policy = generation_policy or resolve_generation_policy(prompt)
+            
             # Build conversation context
             context = self._build_context(conversation_history)
             
@@ -120,45 +337,141 @@ class TraeAIAssistant:
                 if "screen" in multimodal_data:
                     context += "\n[User shared screen content]"
             
-            # Create system prompt for coding assistant
-            system_prompt = """You are Trae AI, an advanced coding assistant. You help developers with code generation, debugging, optimization, architecture design, and best practices. Always provide helpful, accurate responses with working code examples when appropriate."""
-            
-            # Format the full prompt using Gemma chat template
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"{context}\n\n{prompt}"}
-            ]
-            
-            # Apply chat template
-            formatted_prompt = self.tokenizer.apply_chat_template(
-                messages, 
-                tokenize=False, 
-                add_generation_prompt=True
-            )
+            formatted_prompt = self._format_prompt(prompt, context)
             
             # Generate response
             inputs = self.tokenizer(formatted_prompt, return_tensors="pt", truncation=True, max_length=2048)
             if self.device == "cuda":
                 inputs = {k: v.to(self.device) for k, v in inputs.items()}
             
+            prompt_length = inputs['input_ids'].shape[1]
+            stop_criteria = StopSequenceCriteria(
+                self.tokenizer,
+                prompt_length,
+                policy["stop_sequences"],
+                policy["stop_on_code_fence"]
+            )
+            
+            start_time = time.time()
             with torch.no_grad():
                 outputs = self.model.generate(
                     **inputs,
-                    max_new_tokens=512,
-                    temperature=0.7,
-                    do_sample=True,
+                    **sampling_options(policy),
+                    max_new_tokens=policy["max_new_tokens"],
                     pad_token_id=self.tokenizer.pad_token_id,
                     repetition_penalty=1.1,
-                    top_p=0.9
+                    stopping_criteria=StoppingCriteriaList([stop_criteria])
                 )
             
-            response = self.tokenizer.decode(outputs[0][inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+            generated = outputs[0][prompt_length:]
+            if stop_criteria.stop_reason:
+                stop_reason = stop_criteria.stop_reason
+            elif len(generated) >= policy["max_new_tokens"]:
+                stop_reason = "max_new_tokens"
+            else:
+                stop_reason = "eos"
+            generation_stats.record(
+                policy["request_type"],
+                policy["max_new_tokens"],
+                len(generated),
+                stop_reason,
+                time.time() - start_time
+            )
+            
+            response = self.tokenizer.decode(generated, skip_special_tokens=True)
+            response = truncate_at_stop(response, policy["stop_sequences"], stop_reason == "code_fence")
             return response.strip()
             
         except Exception as e:
             logger.error(f"Error generating response: {e}")
             return f"I apologize, but I encountered an error while processing your request: {str(e)}"
     
+    def _format_prompt(self, prompt: str, context: str = "") -> str:
+        """Wrap a user prompt in the system prompt and Gemma chat template"""
+        # Create system prompt for coding assistant
+        system_prompt = """You are Trae AI, an advanced coding assistant. You help developers with code generation, debugging, optimization, architecture design, and best practices. Always provide helpful, accurate responses with working code examples when appropriate."""
+        
+        # Format the full prompt using Gemma chat template
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": f"{context}\n\n{prompt}"}
+        ]
+        
+        # Apply chat template
+        return self.tokenizer.apply_chat_template(
+            messages, 
+            tokenize=False, 
+            add_generation_prompt=True
+        )
+    
+    def bucket_by_length(self, items: List[Dict[str, Any]], max_batch_size: int = BATCH_MAX_SIZE,
+                         max_batch_tokens: int = BATCH_MAX_TOKENS) -> List[List[Dict[str, Any]]]:
+        """Group batch items of similar tokenized length so padding stays small
+        
+        Items are first split by decoding policy, since every row of a
+        generate() call shares one budget, sampling setup and stop sequences.
+        """
+        groups: Dict[tuple, List[Dict[str, Any]]] = {}
+        for item in items:
+            item["policy"] = resolve_generation_policy(item["message"], item.get("context"))
+            item["prompt"] = self._format_prompt(item["message"])
+            policy = item["policy"]
+            key = (policy["max_new_tokens"], policy["temperature"], policy["stop_on_code_fence"],
+                   tuple(policy["stop_sequences"]))
+            groups.setdefault(key, []).append(item)
+        
+        batches = []
+        for group in groups.values():
+            lengths = [
+                len(ids) for ids in
+                self.tokenizer([item["prompt"] for item in group], truncation=True, max_length=2048)["input_ids"]
+            ]
+            
+            current = []
+            for length, item in sorted(zip(lengths, group), key=lambda pair: pair[0]):
+                # Items are sorted ascending, so the newest item sets the padded width
+                if current and (len(current) >= max_batch_size or (len(current) + 1) * length > max_batch_tokens):
+                    batches.append(current)
+                    current = []
+                current.append(item)
+            if current:
+                batches.append(current)
+        
+        return batches
+    
+    def generate_batch(self, prompts: List[str], policy: Dict[str, Any]) -> List[str]:
+        """Generate responses for a padded batch of formatted prompts (blocking, run in a worker thread)"""
+        inputs = self.tokenizer(prompts, return_tensors="pt", padding=True, truncation=True, max_length=2048)
+        if self.device == "cuda":
+            inputs = {k: v.to(self.device) for k, v in inputs.items()}
+        
+        # Prompts are left-padded, so every completion starts at the same offset
+        prompt_length = inputs['input_ids'].shape[1]
+        stop_criteria = StopSequenceCriteria(
+            self.tokenizer,
+            prompt_length,
+            policy["stop_sequences"],
+            policy["stop_on_code_fence"],
+            batch_size=len(prompts)
+        )
+        
+        with torch.no_grad():
+            outputs = self.model.generate(
+                **inputs,
+                **sampling_options(policy),
+                max_new_tokens=policy["max_new_tokens"],
+                pad_token_id=self.tokenizer.pad_token_id,
+                repetition_penalty=1.1,
+                stopping_criteria=StoppingCriteriaList([stop_criteria])
+            )
+        
+        responses = self.tokenizer.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+        # Rows that stopped early kept decoding until the whole batch was done
+        return [
+            truncate_at_stop(response, policy["stop_sequences"], stop_reason == "code_fence").strip()
+            for response, stop_reason in zip(responses, stop_criteria.stop_reasons)
+        ]
+    
     def _build_context(self, conversation_history: List[ChatMessage]) -> str:
         """Build conversation context from history"""
         if not conversation_history:
@@ -171,16 +484,25 @@ class TraeAIAssistant:
         
         return "\n".join(context_lines)
     
-    async def process_image(self, image_data: str) -> str:
-        """Basic image processing placeholder"""
+    async def process_image(self, image_data: Union[str, bytes]) -> str:
+        """Decode and preprocess an uploaded image"""
         try:
-            # For now, just acknowledge image upload
-            # Can be enhanced with vision models later
-            return "Image received and processed"
+            pixels, info = await self.image_preprocessor.preprocess(image_data)
+            # Pixels are ready for a vision model; for now just acknowledge the image
+            return f"Image received and processed ({info['width']}x{info['height']})"
         except Exception as e:
             logger.error(f"Error processing image: {e}")
             return "Unable to process image"
     
+    async def process_screen_frame(self, frame_data: str, region: Optional[List[int]] = None) -> str:
+        """Preprocess a screen-share frame, batched with other queued frames"""
+        try:
+            pixels, info = await self.frame_batcher.submit(frame_data, tuple(region) if region else None)
+            return f"Screen frame received and processed ({info['width']}x{info['height']})"
+        except Exception as e:
+            logger.error(f"Error processing screen frame: {e}")
+            return "Unable to process screen frame"
+    
     async def process_speech(self, audio_data: bytes) -> str:
         """Basic speech processing placeholder"""
         try:
@@ -191,18 +513,448 @@ class TraeAIAssistant:
             logger.error(f"Error processing speech: {e}")
             return ""
 
+class SessionStream:
+    """Sequenced outbound frames for one client session
+    
+    A session id is created once per page by the client and sent with every
+    message, so replies go only to the sockets of the session that asked for
+    them, never to other clients using the same conversation id. Every frame gets the next sequence number and is kept in a bounded
+    replay buffer. Generations run as tasks owned by the stream rather than
+    by a socket, so a reconnecting client can ``resume`` with its last seen
+    sequence number, receive what it missed and keep receiving the rest of
+    a still-running answer.
+    
+    Sequence numbers only live in memory, so every stream also has an
+    ``epoch`` id. A client holding numbers from another epoch (after a
+    server restart) must start counting again.
+    """
+    
+    def __init__(self, session_id: str, max_frames: int = REPLAY_BUFFER_SIZE):
+        self.session_id = session_id
+        self.epoch = uuid.uuid4().hex
+        self.next_seq = 1
+        self.buffer = deque(maxlen=max_frames)
+        self.websockets = set()
+        self.tasks = set()
+        self.lock = asyncio.Lock()
+        self.last_active = time.time()
+    
+    @property
+    def generating(self) -> bool:
+        return bool(self.tasks)
+    
+    @property
+    def idle(self) -> bool:
+        """No socket is attached and nothing is generating, so the stream may be evicted"""
+        return not self.websockets and not self.tasks
+    
+    async def send(self, frame_type: str, data: Dict[str, Any]):
+        """Number a frame, buffer it and deliver it to attached sockets"""
+        async with self.lock:
+            frame = {
+                "type": frame_type,
+                "data": data,
+                "session_id": self.session_id,
+                "epoch": self.epoch,
+                "seq": self.next_seq
+            }
+            self.next_seq += 1
+            self.buffer.append(frame)
+            self.last_active = time.time()
+            
+            payload = json.dumps(frame)
+            for websocket in list(self.websockets):
+                try:
+                    await websocket.send_text(payload)
+                except Exception:
+                    # Socket is gone; the frame stays buffered for the reconnect
+                    self.websockets.discard(websocket)
+    
+    async def attach(self, websocket: WebSocket):
+        """Deliver new frames to a socket"""
+        async with self.lock:
+            self.websockets.add(websocket)
+            self.last_active = time.time()
+    
+    async def resume(self, websocket: WebSocket, last_seq: Optional[int] = None, epoch: Optional[str] = None):
+        """Attach a socket and replay every buffered frame after ``last_seq``
+        
+        A client without a ``last_seq`` (first connection) gets no replay,
+        only the current sequence number to count from. A ``last_seq`` from
+        another epoch refers to frames this stream never had, so the client
+        gets the whole buffer and a gap notice.
+        """
+        async with self.lock:
+            self.websockets.add(websocket)
+            self.last_active = time.time()
+            
+            missed = []
+            gap = False
+            if last_seq is not None and epoch is not None and epoch != self.epoch:
+                missed = list(self.buffer)
+                gap = True
+            elif last_seq is not None:
+                oldest_seq = self.buffer[0]["seq"] if self.buffer else self.next_seq
+                # Frames older than the buffer can no longer be replayed
+                gap = last_seq + 1 < oldest_seq
+                missed = [frame for frame in self.buffer if frame["seq"] > last_seq]
+            
+            for frame in missed:
+                await websocket.send_text(json.dumps(frame))
+            
+            await websocket.send_text(json.dumps({
+                "type": "resumed",
+                "data": {
+                    "last_seq": self.next_seq - 1,
+                    "replayed": len(missed),
+                    "gap": gap,
+                    "generating": self.generating
+                },
+                "session_id": self.session_id,
+                "epoch": self.epoch
+            }))
+    
+    def detach(self, websocket: WebSocket):
+        self.websockets.discard(websocket)
+        self.last_active = time.time()
+    
+    def run(self, coro):
+        """Run a generation independently of any socket"""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+    
+    def _task_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        self.last_active = time.time()
+
+def evict_idle_streams():
+    """Drop idle streams past STREAM_IDLE_TTL, then the least recently active idle ones over the cap"""
+    now = time.time()
+    idle = sorted(
+        (stream for stream in session_streams.values() if stream.idle),
+        key=lambda stream: stream.last_active
+    )
+    excess = len(session_streams) - MAX_SESSION_STREAMS + 1  # room for the new stream
+    for stream in idle:
+        if now - stream.last_active < STREAM_IDLE_TTL and excess <= 0:
+            break
+        del session_streams[stream.session_id]
+        excess -= 1
+
+def get_session_stream(session_id: str) -> SessionStream:
+    """Get or create the outbound stream for a client session"""
+    if session_id not in session_streams:
+        # Clients can name new sessions freely, so make room before adding one
+        evict_idle_streams()
+        session_streams[session_id] = SessionStream(session_id)
+    return session_streams[session_id]
+
+class InteractiveGate:
+    """Serializes model access, letting interactive requests go before background work
+    
+    Interactive requests use ``async with gate`` and background batches use
+    ``async with gate.background()``. A waiting interactive request always
+    gets the model before a waiting batch, but an in-flight batch is never
+    preempted, so the worst-case chat delay is one batch generation.
+    """
+    
+    def __init__(self):
+        self.busy = False
+        self.waiting_interactive = 0
+        self.condition = asyncio.Condition()
+    
+    async def __aenter__(self):
+        async with self.condition:
+            self.waiting_interactive += 1
+            try:
+                await self.condition.wait_for(lambda: not self.busy)
+            finally:
+                self.waiting_interactive -= 1
+            self.busy = True
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._release()
+    
+    @contextlib.asynccontextmanager
+    async def background(self):
+        """Hold the model for background work once no interactive request is waiting"""
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.busy and self.waiting_interactive == 0)
+            self.busy = True
+        try:
+            yield
+        finally:
+            await self._release()
+    
+    async def _release(self):
+        async with self.condition:
+            self.busy = False
+            self.condition.notify_all()
+
+class BatchJobRunner:
+    """Runs offline JSONL batch jobs at lower priority than interactive chat
+    
+    Each job lives in its own directory under ``jobs_dir``:
+    ``input.jsonl`` holds the submitted items, ``results.jsonl`` is appended to
+    after every batch and doubles as the checkpoint, and ``job.json`` holds the
+    job status. Unfinished jobs are resumed on startup.
+    """
+    
+    def __init__(self, assistant: "TraeAIAssistant", gate: InteractiveGate, jobs_dir: str = BATCH_JOBS_DIR):
+        self.assistant = assistant
+        self.gate = gate
+        self.jobs_dir = jobs_dir
+        self.jobs: Dict[str, BatchJobStatus] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker_task: Optional[asyncio.Task] = None
+    
+    async def start(self):
+        """Load persisted jobs, requeue unfinished ones and start the worker"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self.queue = asyncio.Queue()
+        
+        for job_id in sorted(os.listdir(self.jobs_dir)):
+            status_path = os.path.join(self.jobs_dir, job_id, "job.json")
+            if not os.path.exists(status_path):
+                continue
+            try:
+                with open(status_path, "r") as f:
+                    job = BatchJobStatus(**json.load(f))
+            except Exception as e:
+                logger.error(f"Skipping unreadable batch job {job_id}: {e}")
+                continue
+            
+            self.jobs[job_id] = job
+            if job.status in ("queued", "running"):
+                logger.info(f"Resuming batch job {job_id} ({job.completed + job.failed}/{job.total} done)")
+                job.status = "queued"
+                await self.queue.put(job_id)
+        
+        self.worker_task = asyncio.create_task(self._worker())
+    
+    async def stop(self):
+        """Cancel the worker; in-progress jobs resume from their checkpoint on restart"""
+        if self.worker_task:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+    
+    def _job_path(self, job_id: str, name: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, name)
+    
+    def _truncate_partial_line(self, results_path: str):
+        """Drop a partially written last line left by an interrupted run"""
+        with open(results_path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                logger.warning(f"Discarding {len(data) - end} bytes of partial output in {results_path}")
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+    
+    def _save_status(self, job: BatchJobStatus):
+        job.updated_at = datetime.now().isoformat()
+        tmp_path = self._job_path(job.job_id, "job.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(job.dict(), f)
+        os.replace(tmp_path, self._job_path(job.job_id, "job.json"))
+    
+    async def submit(self, raw: bytes) -> BatchJobStatus:
+        """Validate a JSONL payload and queue it as a new job
+        
+        Each line is an object with a required ``message`` and optional
+        ``id`` and ``context`` fields, where ``context`` holds the same
+        generation overrides as ``ChatRequest.context``. Raises ValueError on
+        malformed input.
+        """
+        items = []
+        seen_ids = set()
+        for line_no, line in enumerate(raw.decode("utf-8").splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Line {line_no}: invalid JSON ({e})")
+            if not isinstance(item, dict) or not isinstance(item.get("message"), str):
+                raise ValueError(f"Line {line_no}: expected an object with a 'message' string")
+            
+            item_id = str(item.get("id", line_no))
+            if item_id in seen_ids:
+                raise ValueError(f"Line {line_no}: duplicate id '{item_id}'")
+            seen_ids.add(item_id)
+            
+            # Same decoding overrides as ChatRequest.context
+            context = item.get("context")
+            if context is not None and not isinstance(context, dict):
+                raise ValueError(f"Line {line_no}: 'context' must be an object of generation options")
+            try:
+                resolve_generation_policy(item["message"], context)
+            except ValueError as e:
+                raise ValueError(f"Line {line_no}: invalid generation options ({e})")
+            items.append({"id": item_id, "message": item["message"], "context": context})
+        
+        if not items:
+            raise ValueError("Batch file contains no prompts")
+        
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.jobs_dir, job_id))
+        with open(self._job_path(job_id, "input.jsonl"), "w") as f:
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+        
+        now = datetime.now().isoformat()
+        job = BatchJobStatus(
+            job_id=job_id,
+            status="queued",
+            total=len(items),
+            completed=0,
+            failed=0,
+            created_at=now,
+            updated_at=now
+        )
+        self.jobs[job_id] = job
+        self._save_status(job)
+        await self.queue.put(job_id)
+        
+        logger.info(f"Queued batch job {job_id} with {len(items)} prompts")
+        return job
+    
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            job = self.jobs[job_id]
+            try:
+                await self._run_job(job)
+            except Exception as e:
+                logger.error(f"Batch job {job_id} failed: {e}")
+                job.status = "failed"
+                job.error = str(e)
+                self._save_status(job)
+            finally:
+                self.queue.task_done()
+    
+    async def _run_job(self, job: BatchJobStatus):
+        if self.assistant.model is None:
+            raise RuntimeError("Model is not loaded")
+        
+        with open(self._job_path(job.job_id, "input.jsonl"), "r") as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        
+        # Skip anything already checkpointed by a previous run. Counters are
+        # rebuilt from the checkpoint since job.json is saved after it and may lag.
+        done_ids = set()
+        completed = failed = 0
+        results_path = self._job_path(job.job_id, "results.jsonl")
+        if os.path.exists(results_path):
+            # Appending after a partial line would glue the next result onto it
+            self._truncate_partial_line(results_path)
+            with open(results_path, "r") as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                        result_id = result["id"]
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        continue
+                    if result_id in done_ids:
+                        continue
+                    done_ids.add(result_id)
+                    if "error" in result:
+                        failed += 1
+                    else:
+                        completed += 1
+        job.completed = completed
+        job.failed = failed
+        pending = [item for item in items if item["id"] not in done_ids]
+        
+        job.status = "running"
+        self._save_status(job)
+        
+        batches = self.assistant.bucket_by_length(pending) if pending else []
+        logger.info(f"Batch job {job.job_id}: {len(pending)} pending prompts in {len(batches)} batches")
+        
+        with open(results_path, "a") as results_file:
+            for batch in batches:
+                try:
+                    # Interactive chat waiting for the model always goes first
+                    async with self.gate.background():
+                        responses = await asyncio.to_thread(
+                            self.assistant.generate_batch, [item["prompt"] for item in batch], batch[0]["policy"]
+                        )
+                    error = None
+                except Exception as e:
+                    logger.error(f"Batch job {job.job_id}: batch of {len(batch)} failed: {e}")
+                    responses = [None] * len(batch)
+                    error = str(e)
+                
+                timestamp = datetime.now().isoformat()
+                for item, response in zip(batch, responses):
+                    result = {"id": item["id"], "response": response, "timestamp": timestamp}
+                    if error:
+                        result["error"] = error
+                    results_file.write(json.dumps(result) + "\n")
+                results_file.flush()
+                os.fsync(results_file.fileno())
+                
+                if error:
+                    job.failed += len(batch)
+                else:
+                    job.completed += len(batch)
+                self._save_status(job)
+        
+        job.status = "completed"
+        self._save_status(job)
+        logger.info(f"Batch job {job.job_id} completed: {job.completed} ok, {job.failed} failed")
+    
+    async def stream_results(self, job_id: str, poll_interval: float = 1.0):
+        """Yield result lines as they are written until the job finishes"""
+        results_path = self._job_path(job_id, "results.jsonl")
+        position = 0
+        while True:
+            finished = self.jobs[job_id].status in ("completed", "failed")
+            if os.path.exists(results_path):
+                with open(results_path, "r") as f:
+                    f.seek(position)
+                    while True:
+                        line = f.readline()
+                        if not line.endswith("\n"):
+                            break  # Wait for the rest of a partially written line
+                        position = f.tell()
+                        yield line
+            if finished:
+                return
+            await asyncio.sleep(poll_interval)
+
 # Initialize assistant
 assistant = TraeAIAssistant()
+interactive_gate = InteractiveGate()
+batch_runner = BatchJobRunner(assistant, interactive_gate)
 
 @app.on_event("startup")
 async def startup_event():
     """Load models on startup"""
     logger.info("Starting Trae AI Assistant...")
+    assistant.image_preprocessor.start()
+    assistant.frame_batcher.start()
     success = await assistant.load_models()
     if success:
         logger.info("Assistant ready!")
     else:
         logger.error("Failed to load models")
+    await batch_runner.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background batch and image processing"""
+    await batch_runner.stop()
+    await assistant.frame_batcher.stop()
+    assistant.image_preprocessor.stop()
 
 # Static files
 app.mount("/static", StaticFiles(directory="../client"), name="static")
@@ -233,10 +985,21 @@ async def health_check():
         memory_usage=memory_info
     )
 
+@app.get("/stats/generation")
+async def get_generation_stats():
+    """Decode budget vs. actual length per request type"""
+    return generation_stats.summary()
+
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     """Main chat endpoint"""
     try:
+        # Reject bad decoding overrides before touching the conversation
+        try:
+            generation_policy = resolve_generation_policy(request.message, request.context)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid generation options: {e}")
+        
         conversation_id = request.conversation_id or "default"
         
         # Get conversation history
@@ -252,11 +1015,13 @@ async def chat_endpoint(request: ChatRequest):
         history.append(user_message)
         
         # Generate AI response
-        ai_response = await assistant.generate_response(
-            request.message, 
-            history, 
-            request.multimodal_data
-        )
+        async with interactive_gate:
+            ai_response = await assistant.generate_response(
+                request.message, 
+                history, 
+                request.multimodal_data,
+                generation_policy
+            )
         
         # Add AI response to history
         assistant_message = ChatMessage(
@@ -279,6 +1044,8 @@ async def chat_endpoint(request: ChatRequest):
             "timestamp": assistant_message.timestamp
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Chat error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -291,8 +1058,8 @@ async def upload_image(file: UploadFile = File(...), conversation_id: str = "def
         image_data = await file.read()
         image_b64 = base64.b64encode(image_data).decode()
         
-        # Process image
-        description = await assistant.process_image(f"data:image/jpeg;base64,{image_b64}")
+        # Process image from the raw bytes; no need to decode base64 again
+        description = await assistant.process_image(image_data)
         
         return {
             "description": description,
@@ -316,41 +1083,102 @@ async def speech_to_text(file: UploadFile = File(...)):
         logger.error(f"Speech processing error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/batch/jobs", response_model=BatchJobStatus)
+async def submit_batch_job(file: UploadFile = File(...)):
+    """Submit a JSONL file of prompts for offline batch inference"""
+    try:
+        raw = await file.read()
+        return await batch_runner.submit(raw)
+        
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Batch submit error: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/batch/jobs/{job_id}", response_model=BatchJobStatus)
+async def get_batch_job(job_id: str):
+    """Get batch job progress"""
+    if job_id not in batch_runner.jobs:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return batch_runner.jobs[job_id]
+
+@app.get("/batch/jobs/{job_id}/results")
+async def get_batch_results(job_id: str):
+    """Stream batch job results as JSONL while the job runs"""
+    if job_id not in batch_runner.jobs:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    return StreamingResponse(batch_runner.stream_results(job_id), media_type="application/x-ndjson")
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     """WebSocket for real-time communication"""
     await websocket.accept()
     connected_clients[client_id] = websocket
+    attached_streams = set()
+    
+    def session_of(data: Dict[str, Any]) -> str:
+        # Clients without a session id get a stream private to this socket
+        return data.get("session_id") or client_id
+    
+    async def attach(session_id: str) -> SessionStream:
+        stream = get_session_stream(session_id)
+        await stream.attach(websocket)
+        attached_streams.add(stream)
+        return stream
     
     try:
         while True:
             data = await websocket.receive_text()
             message_data = json.loads(data)
             
-            if message_data["type"] == "chat":
-                # Handle chat message
-                response = await chat_endpoint(ChatRequest(**message_data["data"]))
-                await websocket.send_text(json.dumps({
-                    "type": "chat_response",
-                    "data": response
-                }))
+            if message_data["type"] == "resume":
+                # Reconnecting client: replay frames it has not seen yet
+                resume_data = message_data["data"]
+                last_seq = resume_data.get("last_seq")
+                stream = get_session_stream(session_of(resume_data))
+                await stream.resume(
+                    websocket,
+                    int(last_seq) if last_seq is not None else None,
+                    resume_data.get("epoch")
+                )
+                attached_streams.add(stream)
+            
+            elif message_data["type"] == "chat":
+                # Handle chat message; the reply outlives this socket if it drops
+                stream = await attach(session_of(message_data["data"]))
+                request = ChatRequest(**message_data["data"])
+                stream.run(deliver_chat_response(stream, request))
             
             elif message_data["type"] == "screen_share":
                 # Handle screen sharing
                 screen_data = message_data["data"]["screen"]
-                analysis = await assistant.process_image(screen_data)
-                await websocket.send_text(json.dumps({
-                    "type": "screen_analysis",
-                    "data": {"analysis": analysis}
-                }))
+                stream = await attach(session_of(message_data["data"]))
+                stream.run(deliver_screen_analysis(stream, screen_data, message_data["data"].get("region")))
             
             elif message_data["type"] == "typing":
                 # Broadcast typing indicator
                 await broadcast_typing(client_id, message_data["data"])
                 
     except WebSocketDisconnect:
-        del connected_clients[client_id]
         logger.info(f"Client {client_id} disconnected")
+    finally:
+        connected_clients.pop(client_id, None)
+        for stream in attached_streams:
+            stream.detach(websocket)
+
+async def deliver_chat_response(stream: SessionStream, request: ChatRequest):
+    """Generate a chat reply and send it on the session stream"""
+    try:
+        response = await chat_endpoint(request)
+        await stream.send("chat_response", response)
+    except HTTPException as e:
+        await stream.send("error", {"detail": e.detail})
+
+async def deliver_screen_analysis(stream: SessionStream, screen_data: str, region: Optional[List[int]] = None):
+    """Analyze a screen frame and send the result on the session stream"""
+    analysis = await assistant.process_screen_frame(screen_data, region)
+    await stream.send("screen_analysis", {"analysis": analysis})
 
 async def broadcast_message(conversation_id: str, message: ChatMessage):
     """Broadcast message to all connected clients"""
@@ -385,13 +1213,3 @@ async def broadcast_typing(sender_id: str, typing_data: dict):
                 await websocket.send_text(json.dumps(message_data))
             except:
                 pass
-
-if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(
-        "app:app",
-        host="0.0.0.0",
-        port=8000,
-        reload=True,
-        log_level="info"
-    )
\ No newline at end of file
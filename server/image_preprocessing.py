@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Image preprocessing pipeline for Trae AI
+Decodes, crops, resizes and normalizes uploaded images and screen-share frames
+in a process pool, writing pixels into shared memory instead of pickling arrays
+
+This module is imported by pool workers, so it must stay free of torch,
+transformers and FastAPI imports. Spawned workers also re-import the script
+the server was launched from, which is why the entry point lives in main.py
+rather than app.py.
+"""
+
+import os
+import asyncio
+import base64
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional, Tuple, Union, Any
+
+import numpy as np
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Model input configuration
+IMAGE_INPUT_SIZE = int(os.environ.get("IMAGE_INPUT_SIZE", "224"))  # square side in pixels
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", str(min(4, os.cpu_count() or 1))))
+IMAGE_MEAN = (0.485, 0.456, 0.406)  # ImageNet RGB statistics
+IMAGE_STD = (0.229, 0.224, 0.225)
+
+# Screen frame batching
+FRAME_BATCH_SIZE = int(os.environ.get("FRAME_BATCH_SIZE", "4"))
+FRAME_BATCH_WAIT = float(os.environ.get("FRAME_BATCH_WAIT", "0.05"))  # seconds to wait for more frames
+
+ImageInput = Union[str, bytes]
+Region = Tuple[int, int, int, int]  # x, y, width, height
+
+def _decode_image(image_data: ImageInput) -> np.ndarray:
+    """Decode a base64 data URL, base64 string or raw bytes to an RGB array"""
+    if isinstance(image_data, str):
+        if image_data.startswith("data:"):
+            image_data = image_data.split(",", 1)[1]
+        image_data = base64.b64decode(image_data)
+
+    image = cv2.imdecode(np.frombuffer(image_data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Unsupported or corrupt image data")
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def _crop_region(image: np.ndarray, region: Optional[Region]) -> np.ndarray:
+    """Crop a region of interest, clamped to the image bounds"""
+    if not region:
+        return image
+
+    height, width = image.shape[:2]
+    x, y, w, h = (int(v) for v in region)
+    x0, y0 = max(0, x), max(0, y)
+    x1, y1 = min(width, x + w), min(height, y + h)
+    if x1 <= x0 or y1 <= y0:
+        raise ValueError(f"Region {region} is outside the {width}x{height} image")
+    return image[y0:y1, x0:x1]
+
+def _preprocess_into_shared(shm_name: str, shape: Tuple[int, ...], index: int,
+                            image_data: ImageInput, region: Optional[Region]) -> Dict[str, Any]:
+    """Pool worker: preprocess one image into slot ``index`` of a shared batch buffer"""
+    image = _decode_image(image_data)
+    original_height, original_width = image.shape[:2]
+    image = _crop_region(image, region)
+
+    size = shape[1]
+    interpolation = cv2.INTER_AREA if max(image.shape[:2]) > size else cv2.INTER_LINEAR
+    image = cv2.resize(image, (size, size), interpolation=interpolation)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        batch = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        np.subtract(image, np.multiply(IMAGE_MEAN, 255.0), out=batch[index], dtype=np.float32)
+        batch[index] /= np.multiply(IMAGE_STD, 255.0).astype(np.float32)
+        del batch  # Release the buffer export before closing
+    finally:
+        shm.close()
+
+    return {"width": original_width, "height": original_height}
+
+class ImagePreprocessor:
+    """Runs image preprocessing in a process pool off the event loop"""
+
+    def __init__(self, input_size: int = IMAGE_INPUT_SIZE, workers: int = IMAGE_WORKERS):
+        self.input_size = input_size
+        self.workers = workers
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        """Start the worker pool"""
+        # Spawn so workers never inherit the parent's CUDA context
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"Image preprocessing pool started with {self.workers} workers")
+
+    def stop(self):
+        """Shut down the worker pool"""
+        if self.executor:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+
+    def _restart_broken_pool(self, broken: ProcessPoolExecutor):
+        """Replace a pool whose worker died (e.g. a decoder crash)
+
+        Only the caller that saw ``broken`` still installed replaces it, so
+        concurrent callers never shut down a pool another one just started.
+        """
+        if self.executor is not broken:
+            return
+        logger.error("Image preprocessing pool is broken, restarting it")
+        # A broken pool has no live work to wait for; don't block the event loop
+        broken.shutdown(wait=False)
+        self.start()
+
+    async def preprocess_batch(self, images: List[ImageInput],
+                               regions: Optional[List[Optional[Region]]] = None
+                               ) -> Tuple[np.ndarray, List[Dict[str, Any]]]:
+        """Preprocess several images in parallel
+
+        Returns a float32 array of shape (N, size, size, 3) normalized with
+        ImageNet statistics, plus per-image metadata. Images that fail to
+        decode are left zeroed and carry an ``error`` entry in their metadata.
+        """
+        if self.executor is None:
+            raise RuntimeError("Image preprocessor is not started")
+        if not images:
+            return np.zeros((0, self.input_size, self.input_size, 3), dtype=np.float32), []
+
+        regions = regions or [None] * len(images)
+        shape = (len(images), self.input_size, self.input_size, 3)
+        shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+        try:
+            batch = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            batch.fill(0)
+
+            loop = asyncio.get_running_loop()
+            executor = self.executor
+            futures = []
+            try:
+                for index, (image, region) in enumerate(zip(images, regions)):
+                    futures.append(loop.run_in_executor(
+                        executor, _preprocess_into_shared, shm.name, shape, index, image, region
+                    ))
+            except BrokenProcessPool:
+                # The pool broke before this call; replace it so later calls can succeed
+                for future in futures:
+                    future.cancel()
+                self._restart_broken_pool(executor)
+                raise
+            results = await asyncio.gather(*futures, return_exceptions=True)
+
+            if any(isinstance(result, BrokenProcessPool) for result in results):
+                self._restart_broken_pool(executor)
+
+            metadata = []
+            for result in results:
+                if isinstance(result, BaseException):
+                    logger.error(f"Error preprocessing image: {result}")
+                    metadata.append({"error": str(result)})
+                else:
+                    metadata.append(result)
+
+            pixels = batch.copy()
+            del batch  # Release the buffer export before closing
+            return pixels, metadata
+        finally:
+            shm.close()
+            shm.unlink()
+
+    async def preprocess(self, image: ImageInput, region: Optional[Region] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Preprocess a single image"""
+        pixels, metadata = await self.preprocess_batch([image], [region])
+        if "error" in metadata[0]:
+            raise ValueError(metadata[0]["error"])
+        return pixels[0], metadata[0]
+
+class FrameBatcher:
+    """Collects queued screen frames and preprocesses them together"""
+
+    def __init__(self, preprocessor: ImagePreprocessor, max_batch_size: int = FRAME_BATCH_SIZE,
+                 max_wait: float = FRAME_BATCH_WAIT):
+        self.preprocessor = preprocessor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Start collecting frames"""
+        self.queue = asyncio.Queue()
+        self.worker_task = asyncio.create_task(self._worker())
+
+    async def stop(self):
+        """Stop collecting frames"""
+        if self.worker_task:
+            self.worker_task.cancel()
+            try:
+                await self.worker_task
+            except asyncio.CancelledError:
+                pass
+
+    async def submit(self, frame: ImageInput, region: Optional[Region] = None) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Queue a frame and wait for its preprocessed pixels"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((frame, region, future))
+        return await future
+
+    async def _worker(self):
+        while True:
+            pending = [await self.queue.get()]
+
+            # Give closely spaced frames a moment to join the batch
+            deadline = asyncio.get_running_loop().time() + self.max_wait
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # One bad batch must not kill the worker, or every later submit() hangs
+            try:
+                pixels, metadata = await self.preprocessor.preprocess_batch(
+                    [frame for frame, _, _ in pending],
+                    [region for _, region, _ in pending]
+                )
+
+                for index, (_, _, future) in enumerate(pending):
+                    if future.done():
+                        continue  # Caller went away
+                    if "error" in metadata[index]:
+                        future.set_exception(ValueError(metadata[index]["error"]))
+                    else:
+                        future.set_result((pixels[index], metadata[index]))
+            except Exception as e:
+                logger.error(f"Error preprocessing frame batch: {e}")
+                for _, _, future in pending:
+                    if not future.done():
+                        future.set_exception(e)
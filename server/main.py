@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+"""
+Trae AI server entry point
+Runs the FastAPI app in app.py under uvicorn
+
+Kept out of app.py on purpose: spawned worker processes (the image
+preprocessing pool) re-import the launching script as __mp_main__, and
+importing app.py there would load torch, transformers and the assistant
+in every worker.
+"""
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        reload=True,
+        log_level="info"
+    )
@@ -206,6 +206,86 @@ class ChatDeploymentTester:
             self.log_test("Image Upload", False, str(e))
             return False
     
+    def test_batch_job(self):
+        """Test offline batch job submission and streamed results"""
+        try:
+            prompts = [
+                {"id": "short", "message": "What is a list in Python?"},
+                {"id": "medium", "message": "Review this code: def add(a, b): return a - b"},
+                {"id": "long", "message": "Explain the difference between a process and a thread, with an example in Python."}
+            ]
+            batch_file = BytesIO("\n".join(json.dumps(p) for p in prompts).encode())
+            
+            files = {
+                'file': ('prompts.jsonl', batch_file, 'application/x-ndjson')
+            }
+            response = self.session.post(f"{self.base_url}/batch/jobs", files=files, timeout=30)
+            if response.status_code != 200:
+                self.log_test("Batch Job", False, f"Submit HTTP {response.status_code}")
+                return False
+            
+            job_id = response.json()['job_id']
+            
+            # Results stream until the job finishes
+            response = self.session.get(f"{self.base_url}/batch/jobs/{job_id}/results", timeout=300)
+            if response.status_code != 200:
+                self.log_test("Batch Job", False, f"Results HTTP {response.status_code}")
+                return False
+            
+            results = [json.loads(line) for line in response.text.splitlines() if line.strip()]
+            result_ids = {result['id'] for result in results}
+            if result_ids == {p['id'] for p in prompts} and all(result.get('response') for result in results):
+                self.log_test("Batch Job", True, f"{len(results)} results streamed")
+                return True
+            else:
+                self.log_test("Batch Job", False, f"Unexpected results: {sorted(result_ids)}")
+                return False
+        except Exception as e:
+            self.log_test("Batch Job", False, str(e))
+            return False
+    
+    def test_generation_stats(self):
+        """Test generation budget overrides and stats reporting"""
+        try:
+            budget = 32
+            response = self.session.get(f"{self.base_url}/stats/generation", timeout=10)
+            if response.status_code != 200:
+                self.log_test("Generation Stats", False, f"Stats HTTP {response.status_code}")
+                return False
+            before = response.json().get('short', {})
+            
+            payload = {
+                "message": "Is Python dynamically typed?",
+                "conversation_id": "test_generation_stats",
+                "context": {"request_type": "short", "max_new_tokens": budget}
+            }
+            response = self.session.post(f"{self.base_url}/chat", json=payload, timeout=30)
+            if response.status_code != 200:
+                self.log_test("Generation Stats", False, f"Chat HTTP {response.status_code}")
+                return False
+            
+            response = self.session.get(f"{self.base_url}/stats/generation", timeout=10)
+            if response.status_code != 200:
+                self.log_test("Generation Stats", False, f"Stats HTTP {response.status_code}")
+                return False
+            after = response.json().get('short', {})
+            
+            requests_added = after.get('requests', 0) - before.get('requests', 0)
+            budget_added = after.get('budget_tokens', 0) - before.get('budget_tokens', 0)
+            generated_added = after.get('generated_tokens', 0) - before.get('generated_tokens', 0)
+            if requests_added == 1 and budget_added == budget and 0 < generated_added <= budget:
+                self.log_test("Generation Stats", True, f"Generated {generated_added}/{budget} tokens")
+                return True
+            else:
+                self.log_test(
+                    "Generation Stats", False,
+                    f"Unexpected stats delta: requests={requests_added} budget={budget_added} generated={generated_added}"
+                )
+                return False
+        except Exception as e:
+            self.log_test("Generation Stats", False, str(e))
+            return False
+    
     def test_api_documentation(self):
         """Test API documentation endpoint"""
         try:
@@ -283,6 +363,8 @@ class ChatDeploymentTester:
             self.test_coding_assistance,
             self.test_conversation_context,
             self.test_image_upload,
+            self.test_batch_job,
+            self.test_generation_stats,
             self.test_performance
         ]
         